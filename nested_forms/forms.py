@@ -1,22 +1,426 @@
 # -*- coding: utf-8 -*-
 import re
 import logging
+import threading
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
 
 from django import forms
-from django.core.exceptions import ValidationError
-from django.db import models
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.db import models, connections, transaction
+from django.db.models import F, Max
 from django.db.models.query import QuerySet
 from django.db.models.related import RelatedObject
-from django.forms.fields import FileField
-from django.forms.formsets import TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, DELETION_FIELD_NAME
+from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.formsets import TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, MAX_NUM_FORM_COUNT, \
+        DELETION_FIELD_NAME, ManagementForm
 from django.forms.models import ModelFormOptions, ModelFormMetaclass, modelformset_factory, \
-        inlineformset_factory, BaseInlineFormSet
+        inlineformset_factory, BaseModelFormSet, BaseInlineFormSet
 from django.http import QueryDict
+from django.template.loader import render_to_string
+from django.utils.datastructures import MultiValueDict, SortedDict
+from django.utils.encoding import StrAndUnicode, force_unicode
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 from django.contrib.contenttypes.generic import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 
 logger = logging.getLogger(__name__)
 
-class ComplexBaseInlineFormSet(BaseInlineFormSet):
+# Marks threads currently running a validation task, so that nested forms
+# validate serially instead of submitting work to a pool from one of its own
+# workers (which could deadlock a bounded pool).
+_executor_state = threading.local()
+
+# The thread pools built for the formsets_executor numbers, shared by all the
+# forms of the process.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_executor(executor):
+    """
+    Returns executor, or the pool of executor threads shared by all the forms
+    when it is a number. Each pool is built on first use and lives as long as
+    the process, its threads keeping their database connections open.
+    """
+    if not isinstance(executor, (int, long)):
+        return executor
+    _pools_lock.acquire()
+    try:
+        if executor not in _pools:
+            _pools[executor] = ThreadPool(executor)
+        return _pools[executor]
+    finally:
+        _pools_lock.release()
+
+class RenderCache(object):
+    """
+    An in-process cache of rendered forms, which keeps the max_entries most
+    recently used ones. Subclasses can choose another entry to evict.
+
+    Any object with the same get() and set() methods, like a Django cache, can
+    be used instead.
+    """
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self._entries = SortedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                return default
+            # Moves the entry to the end, as the most recently used
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                del self._entries[key]
+            while self._entries and len(self._entries) >= self.max_entries:
+                del self._entries[self.evict()]
+            self._entries[key] = value
+        finally:
+            self._lock.release()
+
+    def evict(self):
+        """
+        Returns the key of the entry to remove when the cache is full: the
+        least recently used one.
+        """
+        return iter(self._entries).next()
+
+def modified_version(field_name, *relations):
+    """
+    Returns a render_version for ComplexModelForm's Meta: the field_name value
+    of the instance and the greatest field_name values of the related objects
+    through relations (one query each).
+    """
+    def version(instance):
+        return (getattr(instance, field_name),) + tuple([
+            getattr(instance, relation).aggregate(version = Max(field_name))['version']
+            for relation in relations
+        ])
+    return version
+
+class ConcurrentModificationError(Exception):
+    """
+    Raised when saving a form whose instance has been changed by someone else
+    since the form was displayed.
+    """
+
+class InvalidRowError(ValueError):
+    """
+    Raised by get_empty_form and get_row when the prefix of a formset or of a
+    row, the primary key posted for a row or the counts of its formset are
+    invalid, like stale or forged data.
+    """
+
+def select_for_update(queryset):
+    """
+    Locks the rows of the queryset when they are read, on Django versions that
+    support it.
+    """
+    if hasattr(queryset, 'select_for_update'):
+        return queryset.select_for_update()
+    return queryset
+
+def link_objects(instance, name, objects):
+    """
+    Relates the saved objects to instance through its relation "name".
+
+    Objects already related are skipped: reverse foreign keys and generic
+    relations already pointing to instance, existing many to many pairs.
+    The others are linked with one bulk UPDATE (foreign keys, generic
+    relations) or by the related manager (many to many).
+    """
+    objects = [ obj for obj in objects or [] if obj is not None ]
+    if not objects or instance.pk is None:
+        return
+
+    field = instance._meta.get_field_by_name(name)[0]
+
+    if isinstance(field, GenericRelation):
+        content_type = ContentType.objects.get_for_model(instance)
+        ct_attname = field.rel.to._meta.get_field(field.content_type_field_name).attname
+        missing = [
+            obj for obj in objects
+            if getattr(obj, ct_attname) != content_type.pk or \
+               getattr(obj, field.object_id_field_name) != instance.pk
+        ]
+        if missing:
+            field.rel.to._default_manager.filter(pk__in = [ obj.pk for obj in missing ]).update(**{
+                field.content_type_field_name: content_type,
+                field.object_id_field_name: instance.pk,
+            })
+            for obj in missing:
+                setattr(obj, ct_attname, content_type.pk)
+                setattr(obj, field.object_id_field_name, instance.pk)
+        return
+
+    if isinstance(field, RelatedObject) and not isinstance(field.field, models.ManyToManyField):
+        fk = field.field
+        value = getattr(instance, fk.rel.field_name)
+        missing = [ obj for obj in objects if getattr(obj, fk.attname) != value ]
+        if missing:
+            field.model._default_manager.filter(pk__in = [ obj.pk for obj in missing ]).update(**{
+                fk.name: instance,
+            })
+            for obj in missing:
+                setattr(obj, fk.name, instance)
+        return
+
+    m2m = isinstance(field, RelatedObject) and field.field or field
+    if not m2m.rel.through._meta.auto_created:
+        # Rows of explicit through models are saved by their own forms
+        return
+    # The related manager skips the existing pairs, sends m2m_changed and
+    # writes to the database the instance was read from
+    getattr(instance, name).add(*objects)
+
+def nested_formset_factory(factory, *args, **kwargs):
+    """
+    Builds a formset class with factory (modelformset_factory or
+    inlineformset_factory). The form class it builds for a ComplexModelForm
+    only gets ModelFormOptions from ModelFormMetaclass: it is given the
+    ComplexModelForm options back.
+    """
+    formset_class = factory(*args, **kwargs)
+    form = formset_class.form
+    if issubclass(form, ComplexModelForm) and not isinstance(form._meta, ComplexModelFormOptions):
+        form._meta = ComplexModelFormOptions(getattr(form, 'Meta', None))
+    return formset_class
+
+def resolve_callable(var, args=None, kwargs=None, default=None):
+    if args is None:
+        args = []
+
+    if kwargs is None:
+        kwargs = {}
+
+    if callable(var):
+        return var(*args, **kwargs) or default
+    else:
+        return var or default
+
+class NestedRow(object):
+    """
+    A single row of a nested formset, validated and saved on its own (see
+    ComplexModelForm.get_row).
+    """
+
+    def __init__(self, formset, form, name, parent_instance, counts, index):
+        self.formset = formset
+        self.form = form
+        self.name = name
+        self.parent_instance = parent_instance
+        self.counts = counts
+        self.index = index
+        self.is_new = form.instance.pk is None
+        self.renumbered = {}
+
+    def is_deleted(self):
+        """
+        Returns True when the row is posted for deletion.
+        """
+        return bool(self.formset.can_delete and self.formset._should_delete_form(self.form))
+
+    def is_valid(self):
+        # Rows posted for deletion don't have to be valid
+        return self.is_deleted() or self.form.is_valid()
+
+    @property
+    def errors(self):
+        return self.form.errors
+
+    def save(self, commit=True):
+        """
+        Saves the row and its nested formsets, and links a new object to the
+        parent instance.
+
+        A row posted for deletion deletes its object instead, and is removed
+        from the counts: the prefixes of the following rows are shifted down,
+        as given by renumbered.
+        """
+        if not self.is_valid():
+            return
+
+        if self.is_deleted():
+            if commit:
+                if not self.is_new:
+                    self.form.instance.delete()
+                    if INITIAL_FORM_COUNT in self.counts:
+                        self.counts[INITIAL_FORM_COUNT] -= 1
+                if TOTAL_FORM_COUNT in self.counts:
+                    self.renumbered = dict([
+                        ("%s-%d" % (self.formset.prefix, i), "%s-%d" % (self.formset.prefix, i - 1))
+                        for i in range(self.index + 1, self.counts[TOTAL_FORM_COUNT])
+                    ])
+                    self.counts[TOTAL_FORM_COUNT] -= 1
+            return
+
+        if self.is_new:
+            obj = self.formset.save_new(self.form, commit=commit)
+        else:
+            obj = self.formset.save_existing(self.form, self.form.instance, commit=commit)
+
+        if commit:
+            link_objects(self.parent_instance, self.name, [obj])
+        if commit and self.is_new and INITIAL_FORM_COUNT in self.counts:
+            # The new object is now an initial form of the formset
+            self.counts[INITIAL_FORM_COUNT] += 1
+        return obj
+
+    def management_data(self):
+        """
+        Returns the TOTAL_FORMS and INITIAL_FORMS values of the formset, as
+        posted and updated by the save, keyed by their prefixed names.
+        """
+        return dict([
+            ("%s-%s" % (self.formset.prefix, count_name), value)
+            for count_name, value in self.counts.items()
+        ])
+
+def in_transaction():
+    """
+    Returns True when a database connection of the current thread is in a
+    transaction, whose changes the connections of other threads can't see.
+    """
+    for connection in connections.all():
+        if getattr(connection, 'in_atomic_block', False):
+            return True
+        is_managed = getattr(connection, 'is_managed', None)
+        if is_managed is not None and is_managed():
+            return True
+    return False
+
+class FormTree(object):
+    """
+    Counts the forms bound in a whole tree of nested forms, against the limits
+    set on the root form, and holds the objects removed from its formsets,
+    when the root form deletes them on save.
+    """
+
+    def __init__(self, max_depth=None, max_total_forms=None, defer_deletes=False):
+        self.max_depth = max_depth
+        self.max_total_forms = max_total_forms
+        self.total_forms = 0
+        self.locked = False
+        # The primary keys of the objects to delete on save, by model
+        self.defer_deletes = defer_deletes
+        self.pending_deletes = SortedDict()
+
+class NestedRowsFormSetMixin(object):
+    """
+    Allows a model formset to be bound to a list of dicts (one per form), as
+    decoded from JSON, instead of prefixed keys and a management form.
+
+    Rows holding a primary key edit the matching objects, the other rows add
+    new objects. Rows holding a primary key are bound first, in their order;
+    row_indexes gives the index each form had in the submitted rows.
+
+    Nested ComplexModelForms are given the form tree they belong to and their
+    depth in it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.form_tree = kwargs.pop('form_tree', None)
+        self.depth = kwargs.pop('depth', None)
+        self.rows = kwargs.pop('rows', None)
+        self.row_indexes = None
+        if self.rows is not None:
+            pk_name = self.model._meta.pk.name
+            existing = [ i for i, row in enumerate(self.rows) if row.get(pk_name) not in (None, '') ]
+            self._initial_rows_count = len(existing)
+            self.row_indexes = existing + [
+                i for i, row in enumerate(self.rows) if row.get(pk_name) in (None, '')
+            ]
+            self.rows = [ self.rows[i] for i in self.row_indexes ]
+            # Binds the formset, the rows are used instead of the data.
+            kwargs['data'] = {}
+        super(NestedRowsFormSetMixin, self).__init__(*args, **kwargs)
+
+    def _management_form(self):
+        if self.rows is None:
+            return super(NestedRowsFormSetMixin, self).management_form
+        return ManagementForm(auto_id=self.auto_id, prefix=self.prefix, initial={
+            TOTAL_FORM_COUNT: self.total_form_count(),
+            INITIAL_FORM_COUNT: self.initial_form_count(),
+            MAX_NUM_FORM_COUNT: self.max_num,
+        })
+    management_form = property(_management_form)
+
+    def _cached_empty_form(self):
+        """
+        The empty form is built once per formset, however many times it is
+        rendered.
+        """
+        if not hasattr(self, '_empty_form'):
+            self._empty_form = super(NestedRowsFormSetMixin, self).empty_form
+        return self._empty_form
+    empty_form = property(_cached_empty_form)
+
+    def total_form_count(self):
+        if self.rows is None:
+            return super(NestedRowsFormSetMixin, self).total_form_count()
+        return len(self.rows)
+
+    def initial_form_count(self):
+        if self.rows is None:
+            return super(NestedRowsFormSetMixin, self).initial_form_count()
+        return self._initial_rows_count
+
+    def _construct_form(self, i, **kwargs):
+        if self.form_tree is not None and issubclass(self.form, ComplexModelForm):
+            kwargs.setdefault('form_tree', self.form_tree)
+            kwargs.setdefault('depth', self.depth)
+
+        if self.rows is None:
+            return super(NestedRowsFormSetMixin, self)._construct_form(i, **kwargs)
+
+        row = self.rows[i]
+        defaults = {
+            'auto_id': self.auto_id,
+            'data': row,
+            # Nested data holds no uploads: the values of file fields, like
+            # their stored names, aren't files.
+            'files': {},
+        }
+        if i < self.initial_form_count():
+            pk_field = self.model._meta.pk
+            try:
+                pk = pk_field.to_python(row[pk_field.name])
+            except ValidationError:
+                # The primary key field of the form reports the error.
+                pk = None
+            defaults['instance'] = self._existing_object(pk)
+        else:
+            defaults['empty_permitted'] = True
+        defaults.update(kwargs)
+
+        form = self.form(**defaults)
+        self.add_fields(form, i)
+        if hasattr(self, 'fk'):
+            setattr(form.instance, self.fk.get_attname(), self.instance.pk)
+        return form
+
+class ComplexBaseModelFormSet(NestedRowsFormSetMixin, BaseModelFormSet):
+    """
+    The base model formset class of the formsets which aren't inline.
+    """
+
+class ComplexBaseInlineFormSet(NestedRowsFormSetMixin, BaseInlineFormSet):
     """
     A custom base inline formset class, that saves subformsets automatically
     """
@@ -29,8 +433,7 @@ class ComplexBaseInlineFormSet(BaseInlineFormSet):
 
         if commit and hasattr(form, 'formsets') and isinstance(form.formsets, dict):
             for formset_name, formset in form.formsets.items():
-                objects = formset.save()
-                getattr(obj, formset_name).add(*objects)
+                link_objects(obj, formset_name, formset.save())
 
         return obj
 
@@ -75,15 +478,239 @@ class ComplexBaseInlineFormSet(BaseInlineFormSet):
 
         return saved_objects
 
+class FilesIndex(object):
+    """
+    A read-only view on the uploaded files of a formset, indexed by row.
+
+    Uploads are kept by reference: removing a row only renumbers the index, the
+    files are neither copied nor moved from one key to another. Nested forms
+    build their own index on top of their parent's.
+    """
+
+    def __init__(self, files, prefix):
+        self.files = files
+        self.prefix = prefix
+        self.key_re = re.compile(r"^%s-(?P<form_idx>\d+)-(?P<suffix>.*)$" % re.escape(prefix))
+        self.rows = {}
+        for key in files.keys():
+            match = self.key_re.match(key)
+            if match is not None:
+                self.rows.setdefault(int(match.group('form_idx')), {})[match.group('suffix')] = key
+
+    def _source_key(self, key):
+        match = self.key_re.match(key)
+        if match is None:
+            raise KeyError(key)
+        return self.rows.get(int(match.group('form_idx')), {})[match.group('suffix')]
+
+    def remove_row(self, idx):
+        """
+        Forgets the files of the row idx, the following rows are shifted back.
+        """
+        rows = {}
+        for form_idx, suffixes in self.rows.items():
+            if form_idx < idx:
+                rows[form_idx] = suffixes
+            elif form_idx > idx:
+                rows[form_idx - 1] = suffixes
+        self.rows = rows
+
+    def keys(self):
+        return [
+            "%s-%d-%s" % (self.prefix, form_idx, suffix)
+            for form_idx, suffixes in sorted(self.rows.items())
+            for suffix in sorted(suffixes)
+        ]
+
+    def __len__(self):
+        return sum([ len(suffixes) for suffixes in self.rows.values() ])
+
+    def __contains__(self, key):
+        try:
+            self._source_key(key)
+        except KeyError:
+            return False
+        return True
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        return self.files[self._source_key(key)]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getlist(self, key):
+        try:
+            source_key = self._source_key(key)
+        except KeyError:
+            return []
+        if hasattr(self.files, 'getlist'):
+            return self.files.getlist(source_key)
+        return [ self.files[source_key] ]
+
+    def items(self):
+        return [ (key, self[key]) for key in self.keys() ]
+
+    def copy(self):
+        """
+        Returns a MultiValueDict holding the same uploads, not copies of them.
+        """
+        return MultiValueDict(dict([ (key, self.getlist(key)) for key in self.keys() ]))
+
+class FormsetErrors(StrAndUnicode):
+    """
+    The errors of a nested formset, as stored in its parent form's errors.
+
+    Nothing is formatted until the errors are rendered: as_tree() gives a
+    structure that can be dumped to JSON, iterating gives the messages prefixed
+    by the name of the field they belong to.
+    """
+
+    def __init__(self, formset):
+        self.formset = formset
+
+    def __unicode__(self):
+        return self.as_ul()
+
+    def __iter__(self):
+        for name, message in self.messages():
+            yield u"%s: %s" % (name, message)
+
+    def __len__(self):
+        return len(list(self.messages()))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def forms_errors(self):
+        """
+        Yields (index, form, errors) for each form of the formset, except the
+        forms marked for deletion, which the formset doesn't validate.
+        """
+        formset = self.formset
+        for i, (form, errors) in enumerate(zip(formset.forms, formset.errors)):
+            if formset.can_delete and formset._should_delete_form(form):
+                continue
+            yield i, form, errors
+
+    def row_index(self, i):
+        """
+        Returns the index of the form i in the rows submitted for the formset,
+        which binds the rows holding a primary key first.
+        """
+        row_indexes = getattr(self.formset, 'row_indexes', None)
+        if row_indexes is None:
+            return i
+        return row_indexes[i]
+
+    def messages(self, prefix=None):
+        """
+        Yields (name, message) pairs, name being the prefixed name of the field
+        in error (or the prefix of the form or formset for global errors).
+
+        Rows bound to nested data have no prefix of their own: they are named
+        after the formset's prefix and their index in the submitted rows.
+        prefix is the name of the row the formset belongs to, when that row
+        has no prefix.
+        """
+        formset_prefix = self.formset.prefix
+        if prefix:
+            formset_prefix = "%s-%s" % (prefix, formset_prefix)
+        for message in self.formset.non_form_errors():
+            yield formset_prefix, force_unicode(message)
+        for i, form, errors in self.forms_errors():
+            row_prefix = form.prefix or "%s-%d" % (formset_prefix, self.row_index(i))
+            for field, field_errors in errors.items():
+                if isinstance(field_errors, FormsetErrors):
+                    for name, message in field_errors.messages(form.prefix is None and row_prefix or None):
+                        yield name, message
+                    continue
+                if field == NON_FIELD_ERRORS:
+                    name = row_prefix
+                else:
+                    name = "%s-%s" % (row_prefix, field)
+                for message in field_errors:
+                    yield name, force_unicode(message)
+
+    def as_tree(self):
+        """
+        Returns the errors as a dict, with the formset's own errors and the
+        errors of each of its forms, in the order of the forms or of the
+        submitted rows (forms marked for deletion have none).
+        """
+        forms = [ {} for form in self.formset.forms ]
+        for i, form, errors in self.forms_errors():
+            forms[self.row_index(i)] = dict([
+                (field, isinstance(field_errors, FormsetErrors) and field_errors.as_tree() or \
+                    [ force_unicode(message) for message in field_errors ])
+                for field, field_errors in errors.items()
+            ])
+        return {
+            'non_form_errors': [ force_unicode(message) for message in self.formset.non_form_errors() ],
+            'forms': forms,
+        }
+
+    def as_ul(self):
+        return mark_safe(u'<ul class="errorlist">%s</ul>' % ''.join([
+            u'<li>%s</li>' % conditional_escape(message) for message in self
+        ]))
+
+    def as_text(self):
+        return u'\n'.join([ u'* %s' % message for message in self ])
+
 class ComplexModelFormOptions(ModelFormOptions):
     """
-    Adds the options "formsets" and "formsets_order" to the ComplexModelForm's Meta.
+    Adds the options "formsets", "formsets_order", "formsets_executor",
+    "formsets_parallel_rows", "formsets_files_by_reference",
+    "formsets_max_forms", "formsets_max_depth", "formsets_max_total_forms",
+    "formsets_lock", "version_field", "render_cache", "render_version" and
+    "render_key_prefix" to the ComplexModelForm's Meta.
+
+    formsets_executor is either a number of threads or an object with a
+    ``map(func, items)`` method (a ThreadPool, a concurrent.futures executor...)
+    used to validate sibling formsets concurrently.
+    formsets_parallel_rows is the number of forms from which the rows of a
+    formset are also validated on the executor.
+    formsets_files_by_reference makes the formsets read the uploaded files
+    through a FilesIndex instead of a copy of the files.
+    formsets_max_forms is the default number of forms a formset can be bound
+    to (each formset can set its own "max_forms"). formsets_max_depth and
+    formsets_max_total_forms limit the nesting levels and the number of forms
+    bound in the whole tree of nested forms; they are read on the root form.
+    formsets_lock makes save() lock the instance and the nested objects it
+    changes before changing anything, in a single transaction.
+    version_field is the name of an integer field of the model incremented by
+    every locked save, to detect concurrent changes.
+    render_cache (a RenderCache, or any object with get and set methods) and
+    render_version (the name of a field of the model, or a function of the
+    instance) enable the cache of render_readonly. render_key_prefix sets
+    apart the cache entries of the form class, which default to its module,
+    name, model, fields and formsets.
     """
 
     def __init__(self, options=None):
         super(ComplexModelFormOptions, self).__init__(options)
         self.formsets = getattr(options, 'formsets', None)
         self.formsets_order = getattr(options, 'formsets_order', None)
+        self.formsets_executor = getattr(options, 'formsets_executor', None)
+        self.formsets_parallel_rows = getattr(options, 'formsets_parallel_rows', None)
+        self.formsets_files_by_reference = getattr(options, 'formsets_files_by_reference', False)
+        self.formsets_max_forms = getattr(options, 'formsets_max_forms', None)
+        self.formsets_max_depth = getattr(options, 'formsets_max_depth', None)
+        self.formsets_max_total_forms = getattr(options, 'formsets_max_total_forms', None)
+        self.formsets_lock = getattr(options, 'formsets_lock', False)
+        self.version_field = getattr(options, 'version_field', None)
+        self.render_cache = getattr(options, 'render_cache', None)
+        # Functions set in Meta are read as unbound methods
+        render_version = getattr(options, 'render_version', None)
+        self.render_version = getattr(render_version, 'im_func', render_version)
+        self.render_key_prefix = getattr(options, 'render_key_prefix', None)
 
 class ComplexModelFormMetaclass(ModelFormMetaclass):
     """
@@ -133,7 +760,11 @@ class ComplexModelForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         self.safe_delete = kwargs.pop("safe_delete", [])
+        self.executor = kwargs.pop("executor", self._meta.formsets_executor)
         parent_instance_name, parent_instance = kwargs.pop('parent_instance', (None, None))
+        self.form_tree = kwargs.pop('form_tree', None) or self._get_form_tree()
+        self.depth = kwargs.pop('depth', 0)
+        self._limit_errors = {}
 
         super(ComplexModelForm, self).__init__(*args, **kwargs)
 
@@ -159,6 +790,7 @@ class ComplexModelForm(forms.ModelForm):
                             changed_data.append(formset)
                             break
         self._changed_data = changed_data
+        self._formsets_built = True
 
     def init_formsets(self):
         self.formsets = {}
@@ -179,52 +811,126 @@ class ComplexModelForm(forms.ModelForm):
             self.formsets_loaded()
 
     def _get_errors(self):
-        # full_clean is forced because _errors is sometimes partialy filled.
-        self.full_clean()
+        # full_clean is forced because _errors is sometimes partialy filled:
+        # until all the formsets are built, it lacks their errors.
+        if not getattr(self, '_cleaned_with_formsets', False):
+            self.full_clean()
         return super(ComplexModelForm, self)._get_errors()
     errors = property(_get_errors)
 
+    def full_clean(self):
+        super(ComplexModelForm, self).full_clean()
+        # Once the form is built, its errors are computed only once
+        self._cleaned_with_formsets = getattr(self, '_formsets_built', False)
+
     def _clean_fields(self):
         super(ComplexModelForm, self)._clean_fields()
-        for formset_name, formset in getattr(self, 'formsets', {}).items():
-            if not formset.is_valid():
-                for form in formset.forms:
-                    if not form.is_valid():
-                        for name, field in form.fields.items():
-                            # value_from_datadict() gets the data from the data dictionaries.
-                            # Each widget type knows how to retrieve its own data, because some
-                            # widgets split data over several HTML fields.
-                            value = field.widget.value_from_datadict(form.data, form.files, form.add_prefix(name))
-                            try:
-                                if isinstance(field, FileField):
-                                    initial = form.initial.get(name, field.initial)
-                                    value = field.clean(value, initial)
-                                else:
-                                    value = field.clean(value)
-                                if hasattr(form, 'clean_%s' % name) and hasattr(form, 'cleaned_data'):
-                                    value = getattr(form, 'clean_%s' % name)()
-                            except ValidationError, e:
-                                self._errors["%s | %s" % (formset_name, name)] = self.error_class(e.messages)
-
+        formsets = getattr(self, 'formsets', {})
+        for formset_name in self.formset_keys:
+            formset = formsets.get(formset_name)
+            if formset_name in self._limit_errors:
+                self._errors[formset_name] = self.error_class([self._limit_errors[formset_name]])
+            elif formset is None:
+                continue
+            elif formset.is_bound and not formset.is_valid():
+                self._errors[formset_name] = FormsetErrors(formset)
+            elif not formset.is_bound and len(formset.forms) > 0 and len(self.data):
+                # Its rows aren't posted, which makes is_valid() fail
+                self._errors[formset_name] = self.error_class([
+                    "The management form of this formset is missing."
+                ])
 
     def clean(self):
         cleaned_data = super(ComplexModelForm, self).clean()
-        for formset in getattr(self, 'formsets', {}).values():
-            if formset:
-                formset.clean()
+        for formset in self._get_formsets():
+            formset.clean()
         return cleaned_data
 
+    def _get_formsets(self):
+        """
+        Returns the formsets that have been built, in the formset_keys order.
+        """
+        formsets = getattr(self, 'formsets', {})
+        return [
+            formsets[formset_name]
+            for formset_name in self.formset_keys
+            if formsets.get(formset_name) is not None
+        ]
+
+    def _map_formsets(self, func, items):
+        """
+        Calls func on every item and returns the results in the order of items.
+
+        When an executor is set, the calls are made concurrently on it. If some
+        calls raise, the exception of the first failing item is raised, so the
+        outcome is the same as the serial path. Inside a transaction, the calls
+        are made serially: the worker threads' connections couldn't see the
+        changes it hasn't committed yet.
+        """
+        items = list(items)
+        if not self.executor or len(items) < 2 or getattr(_executor_state, 'active', False) \
+                or in_transaction():
+            return [ func(item) for item in items ]
+
+        caller = threading.currentThread()
+
+        def run(item):
+            if threading.currentThread() is caller:
+                try:
+                    return True, func(item)
+                except Exception, e:
+                    return False, e
+
+            _executor_state.active = True
+            try:
+                return True, func(item)
+            except Exception, e:
+                return False, e
+            finally:
+                _executor_state.active = False
+
+        results = list(get_executor(self.executor).map(run, items))
+
+        values = []
+        for succeeded, value in results:
+            if not succeeded:
+                raise value
+            values.append(value)
+        return values
+
+    def _validate_rows(self, formset):
+        """
+        Validates the rows of formset on the executor when it has at least
+        formsets_parallel_rows forms. The rows keep their errors (see
+        _get_errors), the formset then only gathers them.
+        """
+        threshold = self._meta.formsets_parallel_rows
+        if threshold and formset.is_bound and len(formset.forms) >= threshold:
+            self._map_formsets(lambda form: form.is_valid(), formset.forms)
+
+    def _formset_is_valid(self, formset):
+        forms = formset.forms
+        if getattr(formset, 'rows', None) is not None and formset.can_delete:
+            # Rows sent for deletion don't have to be valid
+            forms = [
+                f for f in forms
+                if not f.fields[DELETION_FIELD_NAME].clean(f._raw_value(DELETION_FIELD_NAME))
+            ]
+        return formset.is_valid() and all([ f.is_valid() for f in forms ])
+
     def get_formset_prefix(self, name):
         if self.prefix:
             return self.add_prefix(name)
         else:
             return name
 
-    def get_related_field(self, name):
-        return self._meta.model._meta.get_field_by_name(name)[0]
+    @classmethod
+    def get_related_field(cls, name):
+        return cls._meta.model._meta.get_field_by_name(name)[0]
 
-    def get_related_model(self, name):
-        field = self.get_related_field(name)
+    @classmethod
+    def get_related_model(cls, name):
+        field = cls.get_related_field(name)
         if isinstance(field, GenericRelation):
             return field.related.parent_model
         elif isinstance(field, RelatedObject):
@@ -233,14 +939,335 @@ class ComplexModelForm(forms.ModelForm):
             return field.rel.to
         raise
 
+    @classmethod
+    def _get_related_object(cls, instance, name, pk, row_prefix):
+        """
+        Returns the object pk related to instance through "name", the object
+        of the row row_prefix. Raises InvalidRowError if there is none.
+        """
+        try:
+            return getattr(instance, name).get(pk = pk)
+        except (ObjectDoesNotExist, ValidationError, TypeError, ValueError):
+            raise InvalidRowError("%s is not the primary key of an object of %s" % (pk, row_prefix))
+
+    @classmethod
+    def _get_form_tree(cls):
+        """
+        Returns a new FormTree, with the limits set on the class as root form.
+        """
+        return FormTree(
+            max_depth = cls._meta.formsets_max_depth,
+            max_total_forms = cls._meta.formsets_max_total_forms,
+            defer_deletes = cls._meta.formsets_lock,
+        )
+
+    @classmethod
+    def _get_path_formset(cls, formset_prefix, instance=None, prefix=None, data=None):
+        """
+        Returns the nested formset formset_prefix ("contacts",
+        "contacts-0-photos"...), unbound and without any form, along with its
+        name and the instance it belongs to. Neither the main form nor the
+        formsets on the path are built.
+
+        The rows on the path are the objects whose primary keys are in data
+        (one query per level), new instances when there is none. The formset
+        belongs to the form tree of the class, at its depth in it.
+        """
+        path = formset_prefix
+        if prefix:
+            if not path.startswith("%s-" % prefix):
+                raise InvalidRowError("%s is not a formset of the form %s" % (formset_prefix, prefix))
+            path = path[len(prefix) + 1:]
+
+        tokens = path.split('-')
+        if len(tokens) % 2 == 0 or [ idx for idx in tokens[1::2] if not idx.isdigit() ]:
+            raise InvalidRowError("%s is not the prefix of a nested formset" % formset_prefix)
+        names = tokens[::2]
+
+        form_tree = cls._get_form_tree()
+        if form_tree.max_depth is not None and len(names) > form_tree.max_depth:
+            raise InvalidRowError("%s is nested more than %d levels deep" % (formset_prefix, form_tree.max_depth))
+
+        if instance is None:
+            instance = cls._meta.model()
+
+        form_class = cls
+        for depth, name in enumerate(names):
+            if name not in getattr(form_class, 'base_formsets', {}):
+                raise InvalidRowError("%s is not the prefix of a nested formset" % formset_prefix)
+            params = form_class.base_formsets[name]
+            field = form_class.get_related_field(name)
+            to = form_class.get_related_model(name)
+            form = resolve_callable(params['form'], args=[instance])
+            if depth < len(names) - 1:
+                row_prefix = "-".join(tokens[:2 * depth + 2])
+                if prefix:
+                    row_prefix = "%s-%s" % (prefix, row_prefix)
+                pk = data and data.get("%s-%s" % (row_prefix, to._meta.pk.name))
+                if pk:
+                    instance = form_class._get_related_object(instance, name, pk, row_prefix)
+                else:
+                    instance = to()
+                form_class = form
+
+        # The same formsets as _get_formset: inline ones need a saved instance
+        if isinstance(field, RelatedObject) and instance.pk:
+            formset_class = nested_formset_factory(
+                inlineformset_factory,
+                instance.__class__,
+                to,
+                form,
+                ComplexBaseInlineFormSet,
+                extra = 0,
+                formfield_callback = lambda f, **kwargs: f.formfield(**kwargs),
+                fk_name = params.get('fk_name'),
+            )
+            formset = formset_class(
+                prefix = formset_prefix,
+                instance = instance,
+                queryset = to.objects.none(),
+                form_tree = form_tree,
+                depth = len(names),
+            )
+        else:
+            formset_class = nested_formset_factory(
+                modelformset_factory,
+                to,
+                form,
+                formset = ComplexBaseModelFormSet,
+                extra = 0,
+                can_delete = params.get('can_delete', True),
+                formfield_callback = lambda f, **kwargs: f.formfield(**kwargs),
+            )
+            formset = formset_class(
+                prefix = formset_prefix,
+                queryset = to.objects.none(),
+                form_tree = form_tree,
+                depth = len(names),
+            )
+
+        return formset, name, instance
+
+    @classmethod
+    def get_empty_formset(cls, formset_prefix, instance=None, prefix=None):
+        """
+        Returns the nested formset formset_prefix ("contacts",
+        "contacts-0-photos"...), unbound and without any form, without building
+        the main form nor the formsets on the path. The rows on the path are
+        represented by new instances. No query is made.
+
+        instance is the instance of the main form, prefix its prefix.
+        """
+        return cls._get_path_formset(formset_prefix, instance=instance, prefix=prefix)[0]
+
+    @classmethod
+    def get_empty_form(cls, formset_prefix, index=None, instance=None, prefix=None):
+        """
+        Returns a new form for the nested formset formset_prefix, to render an
+        added row without building nor validating the main form: the empty
+        form (prefixed with __prefix__) when index is None, the form number
+        index otherwise. The nested formsets of the form are empty too.
+        Raises InvalidRowError when formset_prefix is invalid.
+        """
+        formset = cls.get_empty_formset(formset_prefix, instance=instance, prefix=prefix)
+        if index is None:
+            return formset.empty_form
+        return formset._construct_form(index)
+
+    @classmethod
+    def get_row(cls, row_prefix, instance, data=None, files=None, prefix=None):
+        """
+        Returns the single row row_prefix ("contacts-3", "contacts-3-photos-0"...)
+        of a nested formset, bound to data, as a NestedRow. Its form is built
+        with its own nested formsets, but neither the main form nor the other
+        rows are built or validated.
+
+        The row edits the object whose primary key is posted in data, which
+        must be related to the instance, or adds a new one. Raises
+        InvalidRowError when the prefix, the primary key or the form counts
+        are invalid.
+        """
+        if '-' not in row_prefix or not row_prefix.rsplit('-', 1)[1].isdigit():
+            raise InvalidRowError("%s is not the prefix of a row" % row_prefix)
+        formset_prefix, index = row_prefix.rsplit('-', 1)
+        index = int(index)
+
+        formset, name, parent_instance = cls._get_path_formset(
+            formset_prefix, instance=instance, prefix=prefix, data=data
+        )
+
+        data = data or {}
+        counts = {}
+        for count_name in (TOTAL_FORM_COUNT, INITIAL_FORM_COUNT):
+            key = "%s-%s" % (formset_prefix, count_name)
+            value = data.get(key)
+            if value is not None:
+                try:
+                    counts[count_name] = int(value)
+                except (TypeError, ValueError):
+                    raise InvalidRowError("%s is not a number of forms" % key)
+        if index >= counts.get(TOTAL_FORM_COUNT, index + 1):
+            raise InvalidRowError("%s is not a row of %s" % (row_prefix, formset_prefix))
+
+        pk = data.get("%s-%s" % (row_prefix, formset.model._meta.pk.name))
+        initial = counts.get(INITIAL_FORM_COUNT)
+        # The existing rows come first: a new row is added right after them,
+        # so that it keeps its index once it is saved and counted as initial
+        if initial is not None and (index >= initial if pk else index != initial):
+            raise InvalidRowError("%s is not at the index of a%s row of %s" % (
+                row_prefix, pk and "n existing" or " new", formset_prefix
+            ))
+        if pk:
+            obj = cls._get_related_object(parent_instance, name, pk, row_prefix)
+        else:
+            obj = formset.model()
+            if isinstance(formset, BaseInlineFormSet):
+                setattr(obj, formset.fk.name, parent_instance)
+
+        form = formset._construct_form(
+            index,
+            data = data,
+            files = files,
+            instance = obj,
+            empty_permitted = False,
+        )
+        return NestedRow(formset, form, name, parent_instance, counts, index)
+
+    @classmethod
+    def get_render_identity(cls):
+        """
+        Returns what tells the renderings of the class apart from those of
+        other classes in the render cache, without render_key_prefix.
+        """
+        model_opts = cls._meta.model._meta
+        return (
+            cls.__module__, cls.__name__, model_opts.app_label, model_opts.object_name,
+            tuple(cls.base_fields.keys()), tuple(cls.formset_keys),
+        )
+
+    def as_nested_table(self):
+        """
+        Returns the form as table rows, like as_table, followed by one row per
+        formset holding its management form and a table of its forms, nested
+        forms rendered the same way.
+        """
+        output = [ self.as_table() ]
+        for name in getattr(self, 'formset_keys', None) or []:
+            formset = self.formsets.get(name)
+            if formset is None:
+                continue
+            rows = [
+                hasattr(form, 'as_nested_table') and form.as_nested_table() or form.as_table()
+                for form in formset.forms
+            ]
+            output.append(u'<tr><th>%s</th><td>%s<table>%s</table></td></tr>' % (
+                name, unicode(formset.management_form), u'\n'.join(rows)
+            ))
+        return mark_safe(u'\n'.join(output))
+
+    @classmethod
+    def render_readonly(cls, instance, template_name=None, prefix=None):
+        """
+        Renders the unbound form of instance, with template_name (which gets
+        the form as "form") or as_nested_table.
+
+        With the render_cache and render_version options, the result is cached
+        per instance, version and active language: as long as the version is
+        the same, the form and its formsets are neither built nor rendered
+        again.
+        """
+        cache = cls._meta.render_cache
+        version = cls._meta.render_version
+        key = None
+
+        if cache is not None and version is not None and instance.pk is not None:
+            if callable(version):
+                version = version(instance)
+            else:
+                version = getattr(instance, version)
+            key = "nested_forms:%s" % md5(repr((
+                cls._meta.render_key_prefix or cls.get_render_identity(), get_language(),
+                template_name, prefix, instance.pk, version,
+            ))).hexdigest()
+            html = cache.get(key)
+            if html is not None:
+                return mark_safe(html)
+
+        form = cls(instance=instance, prefix=prefix)
+        if template_name:
+            html = render_to_string(template_name, {'form': form})
+        else:
+            html = form.as_nested_table()
+
+        if key is not None:
+            cache.set(key, html)
+        return mark_safe(html)
+
+    def _get_rows(self, name):
+        """
+        Returns the list of dicts given for the formset "name" when the form is
+        bound to nested data, like {"name": ..., "contacts": [{...}, ...]}.
+        Returns None when the formset is bound the usual way.
+        """
+        if isinstance(self.data, QueryDict):
+            return None
+        rows = self.data.get(self.add_prefix(name))
+        if isinstance(rows, (list, tuple)):
+            return rows
+        return None
+
+    def _check_limits(self, name, data, rows, max_forms):
+        """
+        Returns the message of the first limit that would be exceeded by binding
+        the formset "name" to data or rows (or of the invalid rows), None if
+        there is none. The forms to be bound are counted in the form tree.
+        """
+        prefix = self.get_formset_prefix(name)
+
+        if rows is not None:
+            if [ row for row in rows if not isinstance(row, dict) ]:
+                return "Each row must be a dict of field values."
+            nb_forms = len(rows)
+        elif data:
+            if isinstance(data, QueryDict):
+                counts = data.getlist("%s-%s" % (prefix, TOTAL_FORM_COUNT)) + \
+                         data.getlist("%s-%s" % (prefix, INITIAL_FORM_COUNT))
+            else:
+                counts = [
+                    data.get("%s-%s" % (prefix, TOTAL_FORM_COUNT)),
+                    data.get("%s-%s" % (prefix, INITIAL_FORM_COUNT)),
+                ]
+            try:
+                nb_forms = max([ int(count) for count in counts if count not in (None, '') ] or [0])
+            except (TypeError, ValueError):
+                return "The number of forms is invalid."
+        else:
+            return None
+
+        if max_forms is not None and nb_forms > max_forms:
+            return "Ensure there are at most %d forms (it has %d)." % (max_forms, nb_forms)
+
+        tree = self.form_tree
+        if nb_forms and tree.max_depth is not None and self.depth + 1 > tree.max_depth:
+            return "Forms can't be nested more than %d levels deep." % tree.max_depth
+
+        if tree.max_total_forms is not None and tree.total_forms + nb_forms > tree.max_total_forms:
+            return "Ensure there are at most %d nested forms in total." % tree.max_total_forms
+
+        tree.total_forms += max(nb_forms, 0)
+        return None
+
     def _get_formset(self, name, form, extra=None, initial=None, can_delete=True, \
                      update_button=None, fk_name=None, duplicate=False, \
                      exclude_from_duplication=None, queryset=None, allowed_objects=None, \
-                     *args, **kwargs):
+                     max_forms=None, *args, **kwargs):
 
         def shift_keys(data, prefix, idx, has_file=False):
             if not data:
                 return
+            if isinstance(data, FilesIndex):
+                data.remove_row(idx)
+                return
             start = re.compile(r"^%s\-(?P<form_idx>\d+)\-(?P<suffix>.*)$" % prefix)
             if has_file:
                 if (len(data.keys()) > 0):
@@ -284,21 +1311,15 @@ class ComplexModelForm(forms.ModelForm):
                 else:
                     del data[key]
 
-
-        def resolve_callable(var, args=None, kwargs=None, default=None):
-            if args is None:
-                args = []
-
-            if kwargs is None:
-                kwargs = {}
-
-            if callable(var):
-                return var(*args, **kwargs) or default
+        rows = self._get_rows(name)
+        if rows is None:
+            data = self.data.keys() and self.data.copy() or None
+            if self._meta.formsets_files_by_reference or isinstance(self.files, FilesIndex):
+                files = FilesIndex(self.files, self.get_formset_prefix(name)) or None
             else:
-                return var or default
-
-        data = self.data.keys() and self.data.copy() or None
-        files = self.files.keys() and self.files.copy() or None
+                files = self.files.keys() and self.files.copy() or None
+        else:
+            data = files = None
 
         self.full_clean()
 
@@ -332,6 +1353,24 @@ class ComplexModelForm(forms.ModelForm):
                 if not files:
                     files = None
 
+        if max_forms is None:
+            max_forms = self._meta.formsets_max_forms
+        limit_error = self._check_limits(name, data, rows, max_forms)
+        if limit_error:
+            # Nothing is built from the submitted data: the formset stays empty
+            self._limit_errors[name] = limit_error
+            setattr(instance, "_%s" % name, [])
+            formset_class = nested_formset_factory(
+                modelformset_factory,
+                to,
+                form,
+                formset = ComplexBaseModelFormSet,
+                extra = 0,
+                can_delete = can_delete,
+                formfield_callback = lambda f, **kwargs: f.formfield(**kwargs),
+            )
+            return formset_class(prefix = prefix, queryset = to.objects.none())
+
         if data:
             # Asking to delete last form
             if isinstance(data, QueryDict):
@@ -402,7 +1441,15 @@ class ComplexModelForm(forms.ModelForm):
                         name_ = "%s%s" % (prefix_, key)
                         data[name_] = unicode(value)
                 if instance.pk:
-                    getattr(instance, name).all().delete()
+                    related = getattr(instance, name).all()
+                    if self.form_tree.defer_deletes:
+                        # Replaced by the main form's save(), once the rows
+                        # are locked
+                        self.form_tree.pending_deletes.setdefault(to, []).extend(
+                            related.values_list('pk', flat=True)
+                        )
+                    else:
+                        related.delete()
 
                 data.update({ "%s-%s" % (self.add_prefix(name), INITIAL_FORM_COUNT): 0 })
                 data.update({ "%s-%s" % (self.add_prefix(name), TOTAL_FORM_COUNT): len(initial) })
@@ -418,8 +1465,15 @@ class ComplexModelForm(forms.ModelForm):
                             objects = to.objects.filter(pk = data.get("%s%s" % (base_key, instance_pk)) or 0)
                             if objects.exists():
                                 objects_deleted = True
-                                for obj in objects:
-                                    obj.delete()
+                                if self.form_tree.defer_deletes:
+                                    # Deleted by the main form's save(), once
+                                    # the rows are locked
+                                    self.form_tree.pending_deletes.setdefault(to, []).extend(
+                                        objects.values_list('pk', flat=True)
+                                    )
+                                else:
+                                    for obj in objects:
+                                        obj.delete()
 
                         shift_keys(data, prefix, i)
                         shift_keys(files, prefix, i, True)
@@ -430,10 +1484,21 @@ class ComplexModelForm(forms.ModelForm):
             if "%s-%s" % (prefix, TOTAL_FORM_COUNT) not in data.keys():
                 data = files = None
 
+            initial = None
+        elif rows is not None:
             initial = None
         elif not self.instance.pk:
             initial = resolve_callable(initial, args=[instance], default=[])
 
+        if rows is not None:
+            initial_pks = [ row[instance_pk] for row in rows if row.get(instance_pk) not in (None, '') ]
+        else:
+            _data = data or {}
+            initial_pks = [
+                _data.get('%s-%d-%s' % (prefix, x, instance_pk))
+                for x in range(int(_data.get("%s-%s" % (prefix, INITIAL_FORM_COUNT), 0)))
+            ]
+
         formset = None
 
         #print prefix, "%s-%s" % (prefix, TOTAL_FORM_COUNT), data and data.get("%s-%s" % (prefix, TOTAL_FORM_COUNT), "NOT SET")
@@ -444,7 +1509,8 @@ class ComplexModelForm(forms.ModelForm):
                 if not queryset or not isinstance(queryset, QuerySet):
                     queryset = getattr(self.instance, name).all()
 
-                formset_class = inlineformset_factory(
+                formset_class = nested_formset_factory(
+                    inlineformset_factory,
                     instance.__class__,
                     to,
                     form,
@@ -459,66 +1525,71 @@ class ComplexModelForm(forms.ModelForm):
                     prefix = prefix,
                     instance = instance,
                     queryset = queryset,
+                    rows = rows,
+                    form_tree = self.form_tree,
+                    depth = self.depth + 1,
                 )
             else:
                 if not queryset or not isinstance(queryset, QuerySet):
                     queryset = getattr(self.instance, "_%s" % name, None)
                     if not queryset or not isinstance(queryset, QuerySet):
-                        _data = data or {}
                         queryset = to.objects.filter(
                                 pk__in = list(to.objects.filter(
                                     **{
                                         field.rel.related_name or field.related.var_name: self.instance.pk
                                     }
-                                ).values_list("pk", flat=True)) + [
-                                    _data.get('%s-%d-%s' % (prefix, x, instance_pk))
-                                    for x in range(int(_data.get("%s-%s" % (prefix, INITIAL_FORM_COUNT), 0)))
-                                ]
+                                ).values_list("pk", flat=True)) + initial_pks
                         ).distinct()
                 if isinstance(allowed_objects, QuerySet):
                     queryset = allowed_objects.filter(
                         pk__in = queryset.values_list('pk', flat=True)
                     ).distinct()
 
-                formset_class = modelformset_factory(
+                formset_class = nested_formset_factory(
+                    modelformset_factory,
                     to,
                     form,
+                    formset = ComplexBaseModelFormSet,
                     extra = extra,
                     can_delete=can_delete,
                     formfield_callback = lambda f, **kwargs: f.formfield(**kwargs),
                 )
                 formset = formset_class(
-                    data,
-                    files,
+                    data = data,
+                    files = files,
                     prefix = prefix,
                     initial = not self.instance.pk and isinstance(initial, list) and initial or None,
                     queryset = queryset,
+                    rows = rows,
+                    form_tree = self.form_tree,
+                    depth = self.depth + 1,
                 )
         else:
-            if data:
-                _data = data or {}
+            if data or rows:
                 queryset = to.objects.filter(
-                    pk__in = [
-                        _data.get('%s-%d-%s' % (prefix, x, instance_pk))
-                        for x in range(int(_data.get("%s-%s" % (prefix, INITIAL_FORM_COUNT), 0)))
-                    ]
+                    pk__in = initial_pks
                 ).distinct()
             else:
                 queryset = to.objects.none()
 
-            formset_class = modelformset_factory(
+            formset_class = nested_formset_factory(
+                modelformset_factory,
                 to,
                 form,
+                formset = ComplexBaseModelFormSet,
                 extra=extra,
                 can_delete=can_delete,
                 formfield_callback = lambda f, **kwargs: f.formfield(**kwargs),
             )
             formset = formset_class(
-                data,
-                files,
+                data = data,
+                files = files,
                 prefix = prefix,
                 queryset = queryset,
                 initial = not self.instance.pk and isinstance(initial, list) and initial or None,
+                rows = rows,
+                form_tree = self.form_tree,
+                depth = self.depth + 1,
             )
 
 
@@ -526,6 +1597,8 @@ class ComplexModelForm(forms.ModelForm):
             for form in formset.forms:
                 setattr(form.instance, field.field.name, instance)
 
+        self._validate_rows(formset)
+
         try:
             deleted_instance_pks = [ f.instance.pk for f in formset.deleted_forms if f.instance ]
         except:
@@ -545,31 +1618,161 @@ class ComplexModelForm(forms.ModelForm):
         return formset
 
     def is_valid(self):
-        if hasattr(self, "formsets") and isinstance(self.formsets, dict):
-            for formset in self.formsets.values():
-                if len(formset.forms) > 0 and len(self.data) and (
-                    not (formset.is_valid() and all([ f.is_valid() for f in formset.forms ])) or \
-                    len(self.data.getlist(formset.add_prefix(TOTAL_FORM_COUNT))) > 1
-                ):
+        if hasattr(self, "formsets") and isinstance(self.formsets, dict) and len(self.data):
+            formsets = [ formset for formset in self._get_formsets() if len(formset.forms) > 0 ]
+            for formset in formsets:
+                if hasattr(self.data, 'getlist') and \
+                        len(self.data.getlist(formset.add_prefix(TOTAL_FORM_COUNT))) > 1:
                     return False
+
+            if not all(self._map_formsets(self._formset_is_valid, formsets)):
+                return False
         return super(ComplexModelForm, self).is_valid()
 
+    def get_expected_version(self):
+        """
+        Returns the version of the instance the user has edited: the posted
+        value of version_field if any, else the one of the instance.
+        """
+        version_field = self._meta.version_field
+        posted = self.data.get(self.add_prefix(version_field))
+        if posted not in (None, ''):
+            return posted
+        return self.initial.get(version_field, getattr(self.instance, version_field))
+
+    def _collect_changes(self, pks_by_model):
+        """
+        Adds the primary keys of the objects the save is going to change in the
+        formsets of the form, and in those of their changed rows, to
+        pks_by_model (a SortedDict of sets, by model).
+        """
+        for formset_name in self.formset_keys:
+            formset = self.formsets.get(formset_name)
+            if formset is None or not formset.is_bound:
+                continue
+            pks = pks_by_model.setdefault(formset.model, set())
+            posted = set()
+            for form in formset.forms:
+                if form.instance.pk is not None:
+                    posted.add(form.instance.pk)
+                if not form.has_changed():
+                    # Neither saved nor its nested formsets
+                    continue
+                if form.instance.pk is not None:
+                    pks.add(form.instance.pk)
+                if isinstance(form, ComplexModelForm):
+                    form._collect_changes(pks_by_model)
+            if isinstance(formset, ComplexBaseInlineFormSet):
+                # Its save() deletes the related objects which aren't posted
+                pks.update([ obj.pk for obj in formset.get_queryset() if obj.pk not in posted ])
+
+    def lock(self):
+        """
+        Locks the rows the save is going to change, at once and always in the
+        same order: the instance, then the objects of each model of the form
+        tree by primary key, the models by table name. Those are the
+        objects of the changed rows, at any depth, and the objects to delete.
+
+        When version_field is set, raises ConcurrentModificationError if the
+        instance has been changed since the form was displayed.
+
+        Returns the objects to delete, by model and primary key.
+        """
+        instance = self.instance
+        if instance.pk is not None:
+            locked = list(select_for_update(
+                instance.__class__._default_manager.filter(pk = instance.pk)
+            ))
+            version_field = self._meta.version_field
+            if version_field:
+                if not locked or \
+                        unicode(getattr(locked[0], version_field)) != unicode(self.get_expected_version()):
+                    raise ConcurrentModificationError(
+                        "%s has been changed since it was displayed." % instance
+                    )
+                self._locked_version = getattr(locked[0], version_field)
+
+        pks_by_model = SortedDict()
+        self._collect_changes(pks_by_model)
+        pending_deletes = self.form_tree.pending_deletes
+        for model, pks in pending_deletes.items():
+            pks_by_model.setdefault(model, set()).update(pks)
+
+        objects = {}
+        # Forms of other classes may discover the models in another order
+        for model in sorted(pks_by_model.keys(), key = lambda model: model._meta.db_table):
+            pks = pks_by_model[model]
+            if not pks:
+                continue
+            queryset = select_for_update(
+                model._default_manager.filter(pk__in = sorted(pks)).order_by('pk')
+            )
+            if model in pending_deletes:
+                objects[model] = dict([ (obj.pk, obj) for obj in queryset ])
+            else:
+                list(queryset.values_list('pk', flat=True))
+        return objects
+
     def save(self, commit=True):
         if not self.is_valid():
             return
 
+        # Inside the transaction of a parent form, the rows are already locked
+        if commit and self._meta.formsets_lock and not self.form_tree.locked:
+            atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+            return atomic(self._save_locked)()
+
+        instance = self._save(commit)
+        if not commit and self.depth == 0 and self.form_tree.pending_deletes:
+            # The objects are deleted along with the many to many data
+            save_m2m = self.save_m2m
+            def save_m2m_and_delete():
+                save_m2m()
+                self._delete_pending()
+            self.save_m2m = save_m2m_and_delete
+        return instance
+
+    def _save_locked(self):
+        self.form_tree.locked = True
+        try:
+            self._delete_pending(self.lock())
+            return self._save(commit=True)
+        finally:
+            self.form_tree.locked = False
+
+    def _delete_pending(self, objects=None):
+        """
+        Deletes the objects removed from the formsets of the whole form tree,
+        one by one so that their models' delete() is called. objects holds
+        the objects already read by lock(), by model and primary key.
+        """
+        tree = self.form_tree
+        pending, tree.pending_deletes = tree.pending_deletes, SortedDict()
+        for model, pks in pending.items():
+            if objects is not None and model in objects:
+                model_objects = objects[model]
+            else:
+                model_objects = dict([ (obj.pk, obj) for obj in model._default_manager.filter(pk__in = pks) ])
+            for pk in sorted(model_objects):
+                model_objects[pk].delete()
+
+    def _save(self, commit):
+        version = getattr(self, '_locked_version', None)
+        if commit and version is not None:
+            setattr(self.instance, self._meta.version_field, version)
+
         instance = super(ComplexModelForm, self).save(commit=commit)
         if commit:
+            if version is not None:
+                version_field = self._meta.version_field
+                instance.__class__._default_manager.filter(pk = instance.pk).update(**{
+                    version_field: F(version_field) + 1,
+                })
+                setattr(instance, version_field, version + 1)
+                del self._locked_version
+
             for formset_name in self.formset_keys:
                 formset = self.formsets[formset_name]
-                objects = formset.save()
-
-                try:
-                    getattr(
-                        instance,
-                        formset_name
-                    ).add(*objects)
-                except:
-                    pass
+                link_objects(instance, formset_name, formset.save())
 
         return instance
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
+import threading
 
 from django.utils import unittest
 
 from django.forms.formsets import TOTAL_FORM_COUNT, INITIAL_FORM_COUNT, DELETION_FIELD_NAME
-from geniustrade.apps.utils.forms import ComplexModelForm
+from geniustrade.apps.utils.forms import ComplexModelForm, FilesIndex, InvalidRowError, link_objects, RenderCache
 from geniustrade.apps.third_parties.models import ThirdParty, Contact, Country
 from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
 from django import forms
+from django.utils import translation
+from django.conf import settings
+from django.db import connection, reset_queries
 
 def get_contact_form(third_party):
     class ContactForm(forms.ModelForm):
@@ -192,6 +197,146 @@ class ThirdPartyComplexModelFormDefaultTest(ThirdPartyComplexModelFormTest):
         form.save()
         self.assertEqual(self.third_party.contacts.count(), 2)
 
+    def test_invalid_subform_errors(self):
+        query_string = "&".join([
+            "name=test",
+            "contacts-%(total)s=1",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=xxx",
+            "contacts-0-name=test",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'contact_id': self.contact.id,
+        }
+
+        q = QueryDict(query_string)
+        form = self.ThirdPartyForm(q, instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        tree = form.errors['contacts'].as_tree()
+        self.assertEqual(tree['non_form_errors'], [])
+        self.assertEqual(tree['forms'][0].keys(), ['title'])
+        self.assertEqual([ name for name, message in form.errors['contacts'].messages() ], ['contacts-0-title'])
+
+    def test_missing_formset(self):
+        form = self.ThirdPartyForm(QueryDict("name=test"), instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        self.assertTrue('contacts' in form.errors)
+
+    def test_nested_data(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': [
+                {
+                    'id': self.contact.id,
+                    'title': 'mrs',
+                    'name': 'test',
+                },
+                {
+                    'title': 'mr',
+                    'name': 'test2',
+                },
+            ],
+        }, instance=self.third_party)
+
+        self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.formsets['contacts'].forms), 2)
+        form.save()
+        self.assertEqual(self.third_party.contacts.count(), 2)
+        self.assertEqual(self.third_party.contacts.get(pk=self.contact.id).title, 'mrs')
+
+    def test_nested_data_errors_in_submitted_order(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': [
+                {
+                    'title': 'xxx',
+                    'name': 'test2',
+                },
+                {
+                    'id': self.contact.id,
+                    'title': 'mr',
+                    'name': 'test',
+                },
+            ],
+        }, instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        self.assertEqual([ name for name, message in form.errors['contacts'].messages() ], ['contacts-0-title'])
+        self.assertEqual(form.errors['contacts'].as_tree()['forms'][0].keys(), ['title'])
+        self.assertEqual(form.errors['contacts'].as_tree()['forms'][1], {})
+
+    def test_nested_data_invalid_rows(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': ['test'],
+        }, instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        self.assertTrue('contacts' in form.errors)
+
+    def test_nested_data_without_instance(self):
+        data = {
+            'name': 'new',
+            'contacts': [
+                {
+                    'title': 'mr',
+                    'name': 'test2',
+                },
+            ],
+        }
+
+        form = self.ThirdPartyForm(data)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(len(form.formsets['contacts'].forms), 1)
+
+        third_party = ThirdParty(kind='P', step='S1', country=self.third_party.country)
+        form = self.ThirdPartyForm(data, instance=third_party)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(third_party.contacts.get().name, 'test2')
+        third_party.delete()
+
+    def test_nested_data_delete(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': [
+                {
+                    'id': self.contact.id,
+                    DELETION_FIELD_NAME: True,
+                },
+            ],
+        }, instance=self.third_party)
+
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.third_party.contacts.count(), 0)
+
+    def test_nested_data_errors_skip_deleted_rows(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': [
+                {
+                    'id': self.contact.id,
+                    'title': 'xxx',
+                    DELETION_FIELD_NAME: True,
+                },
+                {
+                    'title': 'xxx',
+                    'name': 'test2',
+                },
+            ],
+        }, instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        self.assertEqual(len(form.errors['contacts']), 1)
+        self.assertEqual(form.errors['contacts'].as_tree()['forms'][0], {})
+        self.assertEqual(form.errors['contacts'].as_tree()['forms'][1].keys(), ['title'])
+        self.assertEqual([ name for name, message in form.errors['contacts'].messages() ], ['contacts-1-title'])
+
     def test_bad_form(self):
         query_string = "toto=titi"
         q = QueryDict(query_string)
@@ -297,3 +442,523 @@ class ThirdPartyComplexModelFormWithInitialAndExtraTest(unittest.TestCase):
         self.assertEqual(len(form.formsets['contacts'].forms), 1)
 
 
+
+class ThirdPartyComplexModelFormWithExecutorTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                },
+            }
+            formsets_executor = 2
+            formsets_parallel_rows = 1
+
+    def get_query_string(self, title):
+        return "&".join([
+            "name=test",
+            "contacts-%(total)s=2",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=mr",
+            "contacts-0-name=test",
+            "contacts-1-title=%(title)s",
+            "contacts-1-name=test2",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'contact_id': self.contact.id,
+            'title': title,
+        }
+
+    def test_should_validate_like_serial_path(self):
+        for title, valid in (('mr', True), ('xxx', False)):
+            q = QueryDict(self.get_query_string(title))
+            form = self.ThirdPartyForm(q, instance=self.third_party)
+            serial_form = self.ThirdPartyForm(q, instance=self.third_party, executor=None)
+
+            self.assertEqual(form.is_valid(), valid)
+            self.assertEqual(serial_form.is_valid(), valid)
+            self.assertEqual(form.errors, serial_form.errors)
+
+    def test_rows_should_be_validated_concurrently(self):
+        state = { 'running': 0, 'max_running': 0, 'calls': 0 }
+        lock = threading.Lock()
+        both_running = threading.Event()
+
+        class ContactForm(ComplexModelForm):
+            def clean(self):
+                lock.acquire()
+                state['calls'] += 1
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+                if state['running'] == 2:
+                    both_running.set()
+                lock.release()
+
+                # Serially, the first row would wait for the second one in vain
+                both_running.wait(1)
+
+                lock.acquire()
+                state['running'] -= 1
+                lock.release()
+                return super(ContactForm, self).clean()
+
+            class Meta:
+                model = Contact
+                fields = [
+                    'title',
+                    'name',
+                ]
+
+        class ThirdPartyForm(ComplexModelForm):
+            class Meta:
+                model = ThirdParty
+                fields = [
+                    'name',
+                ]
+                formsets = {
+                    'contacts': {
+                        'form': lambda instance: ContactForm,
+                    },
+                }
+                formsets_executor = 2
+                formsets_parallel_rows = 2
+
+        form = ThirdPartyForm(QueryDict(self.get_query_string('mr')), instance=self.third_party)
+
+        self.assertTrue(form.is_valid())
+        self.assertEqual(state['max_running'], 2)
+        # The formset gathers the errors of the rows without cleaning them again
+        self.assertEqual(state['calls'], 2)
+
+class ThirdPartyComplexModelFormWithLimitsTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                    'max_forms': 2,
+                },
+            }
+
+    def test_too_many_subforms(self):
+        query_string = "&".join([
+            "name=test",
+            "contacts-%(total)s=1",
+            "contacts-%(total)s=1000000",
+            "contacts-%(initial)s=0",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+        }
+
+        q = QueryDict(query_string)
+        form = self.ThirdPartyForm(q, instance=self.third_party)
+
+        self.assertEqual(len(form.formsets['contacts'].forms), 0)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('contacts' in form.errors)
+
+    def test_too_many_nested_rows(self):
+        form = self.ThirdPartyForm({
+            'name': 'test',
+            'contacts': [ { 'title': 'mr', 'name': 'test%d' % i } for i in range(3) ],
+        }, instance=self.third_party)
+
+        self.assertEqual(len(form.formsets['contacts'].forms), 0)
+        self.assertFalse(form.is_valid())
+
+    def test_invalid_total_form_count(self):
+        query_string = "name=test&contacts-%s=x&contacts-%s=0" % (TOTAL_FORM_COUNT, INITIAL_FORM_COUNT)
+
+        form = self.ThirdPartyForm(QueryDict(query_string), instance=self.third_party)
+
+        self.assertFalse(form.is_valid())
+        self.assertTrue('contacts' in form.errors)
+
+class FilesIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.uploads = [ object() for _ in range(3) ]
+        self.files = MultiValueDict({
+            'photos-0-image': [self.uploads[0]],
+            'photos-1-image': [self.uploads[1]],
+            'photos-2-image': [self.uploads[2]],
+            'documents-0-file': [object()],
+        })
+
+    def test_keeps_uploads_by_reference(self):
+        files = FilesIndex(self.files, 'photos')
+        self.assertEqual(len(files), 3)
+        self.assertTrue(files['photos-1-image'] is self.uploads[1])
+        self.assertFalse('documents-0-file' in files)
+
+    def test_remove_row(self):
+        files = FilesIndex(self.files, 'photos')
+        files.remove_row(1)
+        self.assertEqual(files.keys(), ['photos-0-image', 'photos-1-image'])
+        self.assertTrue(files.get('photos-1-image') is self.uploads[2])
+        self.assertEqual(files.get('photos-2-image'), None)
+        self.assertEqual(len(self.files.getlist('photos-1-image')), 1)
+
+    def test_nested_index(self):
+        self.files.setlist('contacts-1-photos-0-image', [self.uploads[0]])
+        contacts = FilesIndex(self.files, 'contacts')
+        contacts.remove_row(0)
+        photos = FilesIndex(contacts, 'contacts-0-photos')
+        self.assertTrue(photos['contacts-0-photos-0-image'] is self.uploads[0])
+
+class ThirdPartyComplexModelFormEmptyFormTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                },
+            }
+
+    def test_empty_form(self):
+        form = self.ThirdPartyForm.get_empty_form('contacts', instance=self.third_party)
+        self.assertEqual(form.prefix, 'contacts-__prefix__')
+        self.assertFalse(form.is_bound)
+        self.assertTrue(DELETION_FIELD_NAME in form.fields)
+
+    def test_nth_form(self):
+        form = self.ThirdPartyForm.get_empty_form('contacts', 3, instance=self.third_party)
+        self.assertEqual(form.prefix, 'contacts-3')
+        self.assertEqual(form.instance.pk, None)
+
+    def test_empty_form_without_instance(self):
+        form = self.ThirdPartyForm.get_empty_form('contacts')
+        self.assertEqual(form.fields.keys(), self.ThirdPartyForm().formsets['contacts'].empty_form.fields.keys())
+
+    def test_unknown_formset(self):
+        self.assertRaises(ValueError, self.ThirdPartyForm.get_empty_form, 'contacts-0-photos')
+
+class ThirdPartyComplexModelFormRowTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                },
+            }
+
+    def test_save_existing_row(self):
+        query_string = "&".join([
+            "contacts-%(total)s=1",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=mrs",
+            "contacts-0-name=test",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'contact_id': self.contact.id,
+        }
+
+        row = self.ThirdPartyForm.get_row('contacts-0', self.third_party, QueryDict(query_string))
+
+        self.assertTrue(row.is_valid())
+        row.save()
+        self.assertEqual(self.third_party.contacts.get().title, 'mrs')
+        self.assertEqual(row.management_data()['contacts-%s' % INITIAL_FORM_COUNT], 1)
+
+    def test_save_new_row(self):
+        query_string = "&".join([
+            "contacts-%(total)s=2",
+            "contacts-%(initial)s=1",
+            "contacts-1-title=mr",
+            "contacts-1-name=test2",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+        }
+
+        row = self.ThirdPartyForm.get_row('contacts-1', self.third_party, QueryDict(query_string))
+
+        self.assertTrue(row.is_valid())
+        row.save()
+        self.assertEqual(self.third_party.contacts.count(), 2)
+        self.assertEqual(row.management_data()['contacts-%s' % INITIAL_FORM_COUNT], 2)
+
+    def test_invalid_row(self):
+        query_string = "contacts-0-id=%d&contacts-0-title=xxx&contacts-0-name=test" % self.contact.id
+
+        row = self.ThirdPartyForm.get_row('contacts-0', self.third_party, QueryDict(query_string))
+
+        self.assertFalse(row.is_valid())
+        self.assertEqual(row.save(), None)
+
+    def test_misplaced_new_row(self):
+        query_string = "&".join([
+            "contacts-%(total)s=4",
+            "contacts-%(initial)s=1",
+            "contacts-3-title=mr",
+            "contacts-3-name=test2",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+        }
+
+        self.assertRaises(InvalidRowError, self.ThirdPartyForm.get_row,
+                          'contacts-3', self.third_party, QueryDict(query_string))
+
+    def test_delete_row(self):
+        query_string = "&".join([
+            "contacts-%(total)s=2",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=xxx",
+            "contacts-0-%(delete)s=on",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'delete': DELETION_FIELD_NAME,
+            'contact_id': self.contact.id,
+        }
+
+        row = self.ThirdPartyForm.get_row('contacts-0', self.third_party, QueryDict(query_string))
+
+        self.assertTrue(row.is_valid())
+        self.assertEqual(row.save(), None)
+        self.assertEqual(self.third_party.contacts.count(), 0)
+        self.assertEqual(row.management_data(), {
+            'contacts-%s' % TOTAL_FORM_COUNT: 1,
+            'contacts-%s' % INITIAL_FORM_COUNT: 0,
+        })
+        self.assertEqual(row.renumbered, {'contacts-1': 'contacts-0'})
+
+    def test_stale_row(self):
+        query_string = "contacts-0-id=%d&contacts-0-title=mr&contacts-0-name=test" % (self.contact.id + 1000)
+
+        self.assertRaises(InvalidRowError, self.ThirdPartyForm.get_row,
+                          'contacts-0', self.third_party, QueryDict(query_string))
+
+    def test_invalid_form_count(self):
+        query_string = "contacts-%s=x&contacts-0-title=mr&contacts-0-name=test" % TOTAL_FORM_COUNT
+
+        self.assertRaises(InvalidRowError, self.ThirdPartyForm.get_row,
+                          'contacts-0', self.third_party, QueryDict(query_string))
+
+    def test_row_form_tree(self):
+        class ThirdPartyForm(self.ThirdPartyForm):
+            class Meta(self.ThirdPartyForm.Meta):
+                formsets_max_total_forms = 5
+
+        row = ThirdPartyForm.get_row('contacts-0', self.third_party, QueryDict(''))
+
+        self.assertEqual(row.formset.form_tree.max_total_forms, 5)
+        self.assertEqual(row.formset.depth, 1)
+
+    def test_row_too_deep(self):
+        class ThirdPartyForm(self.ThirdPartyForm):
+            class Meta(self.ThirdPartyForm.Meta):
+                formsets_max_depth = 0
+
+        self.assertRaises(InvalidRowError, ThirdPartyForm.get_row,
+                          'contacts-0', self.third_party, QueryDict(''))
+
+class LinkObjectsTest(ThirdPartyComplexModelFormTest):
+    def test_link_reverse_foreign_key(self):
+        other = ThirdParty.objects.create(
+            kind='P',
+            name='other',
+            step='S1',
+            country = self.third_party.country,
+        )
+
+        # Already linked: no UPDATE
+        settings.DEBUG = True
+        try:
+            reset_queries()
+            link_objects(self.third_party, 'contacts', [self.contact])
+            self.assertEqual(len(connection.queries), 0)
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(self.third_party.contacts.count(), 1)
+
+        link_objects(other, 'contacts', [self.contact])
+        self.assertEqual(self.contact.third_party, other)
+        self.assertEqual(other.contacts.count(), 1)
+        self.assertEqual(self.third_party.contacts.count(), 0)
+
+        other.delete()
+
+class ThirdPartyComplexModelFormLockTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                },
+            }
+            formsets_lock = True
+
+    def test_delete_on_save(self):
+        query_string = "&".join([
+            "name=test",
+            "contacts-%(total)s=1",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=mr",
+            "contacts-0-name=test",
+            "contacts-0-%(delete)s=",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'delete': DELETION_FIELD_NAME,
+            'contact_id': self.contact.id,
+        }
+
+        q = QueryDict(query_string)
+        form = self.ThirdPartyForm(q, instance=self.third_party)
+
+        self.assertEqual(len(form.formsets['contacts'].forms), 0)
+        self.assertEqual(self.third_party.contacts.count(), 1)
+        form.save()
+        self.assertEqual(self.third_party.contacts.count(), 0)
+
+    def test_delete_on_save_m2m(self):
+        query_string = "&".join([
+            "name=test",
+            "contacts-%(total)s=1",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=mr",
+            "contacts-0-name=test",
+            "contacts-0-%(delete)s=",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'delete': DELETION_FIELD_NAME,
+            'contact_id': self.contact.id,
+        }
+
+        form = self.ThirdPartyForm(QueryDict(query_string), instance=self.third_party)
+
+        third_party = form.save(commit=False)
+        third_party.save()
+        self.assertEqual(self.third_party.contacts.count(), 1)
+        form.save_m2m()
+        self.assertEqual(self.third_party.contacts.count(), 0)
+
+    def test_update_on_save(self):
+        class ThirdPartyForm(self.ThirdPartyForm):
+            class Meta(self.ThirdPartyForm.Meta):
+                formsets = {
+                    'contacts': {
+                        'form': lambda instance: get_contact_form(instance),
+                        'initial': [ { 'title': 'mrs', 'name': 'initial' } ],
+                        'update_button': 'contacts-update',
+                    },
+                }
+
+        query_string = "&".join([
+            "name=test",
+            "contacts-%(total)s=1",
+            "contacts-%(initial)s=1",
+            "contacts-0-id=%(contact_id)d",
+            "contacts-0-title=xxx",
+            "contacts-0-name=test",
+            "contacts-update=",
+        ]) % {
+            'total': TOTAL_FORM_COUNT,
+            'initial': INITIAL_FORM_COUNT,
+            'contact_id': self.contact.id,
+        }
+
+        form = ThirdPartyForm(QueryDict(query_string), instance=self.third_party)
+
+        self.assertEqual(self.third_party.contacts.count(), 1)
+        form.save()
+        self.assertEqual(self.third_party.contacts.count(), 1)
+        self.assertEqual(self.third_party.contacts.get().name, 'initial')
+
+class ThirdPartyComplexModelFormRenderTest(ThirdPartyComplexModelFormTest):
+    class ThirdPartyForm(ComplexModelForm):
+        class Meta:
+            model = ThirdParty
+            fields = [
+                'name',
+            ]
+            formsets = {
+                'contacts': {
+                    'form': lambda instance: get_contact_form(instance),
+                },
+            }
+            render_cache = RenderCache(2)
+            render_version = lambda instance: instance.name
+
+    def test_render_cached(self):
+        cache = self.ThirdPartyForm._meta.render_cache
+        html = self.ThirdPartyForm.render_readonly(self.third_party)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(self.ThirdPartyForm.render_readonly(self.third_party), html)
+        self.assertEqual(len(cache), 1)
+
+        self.assertTrue('name="contacts-%s"' % TOTAL_FORM_COUNT in html)
+        self.assertTrue('name="contacts-0-name"' in html)
+
+        self.third_party.name = 'changed'
+        self.assertNotEqual(self.ThirdPartyForm.render_readonly(self.third_party), html)
+        self.assertEqual(len(cache), 2)
+
+    def test_render_cache_keys(self):
+        cache = RenderCache()
+
+        def get_form_class(form_fields, key_prefix=None):
+            class ThirdPartyForm(ComplexModelForm):
+                class Meta:
+                    model = ThirdParty
+                    fields = form_fields
+                    render_cache = cache
+                    render_version = 'name'
+                    render_key_prefix = key_prefix
+            return ThirdPartyForm
+
+        html = get_form_class(['name']).render_readonly(self.third_party)
+        self.assertNotEqual(get_form_class(['name', 'step']).render_readonly(self.third_party), html)
+        get_form_class(['name'], 'other').render_readonly(self.third_party)
+        self.assertEqual(len(cache), 3)
+
+        translation.activate('fr')
+        try:
+            get_form_class(['name']).render_readonly(self.third_party)
+        finally:
+            translation.deactivate()
+        self.assertEqual(len(cache), 4)
+
+class RenderCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = RenderCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)